@@ -5,12 +5,16 @@ import os
 import base64
 from datetime import datetime
 import hashlib
+from enrollment_writer import EnrollmentWriter
+from gallery import FaceGallery
 
 class BiometricVerifier:
     def __init__(self):
         self.known_faces_dir = 'data/known_faces'
         os.makedirs(self.known_faces_dir, exist_ok=True)
         self.tolerance = 0.6  # Face recognition tolerance (lower is more strict)
+        self.writer = EnrollmentWriter(self.known_faces_dir)
+        self.gallery = FaceGallery(self.known_faces_dir)
 
     def verify_face(self, image_data):
         """Main verification method that handles the full workflow"""
@@ -21,18 +25,22 @@ class BiometricVerifier:
                 return self._error_response("Invalid image data")
 
             # Detect and extract face
-            face_encoding = self._extract_face_encoding(image)
-            if not face_encoding:
+            face_location, face_encoding = self._extract_face_encoding(image)
+            if face_encoding is None:
                 return self._error_response("No face detected")
 
-            # Check against known faces
-            match, person_id = self._match_known_faces(face_encoding)
+            # Match and reserve under one lock so concurrent requests for
+            # the same new face don't both register it
+            with self.gallery.lock:
+                match, person_id = self._match_known_faces(face_encoding)
+                if not match:
+                    person_id = self._reserve_new_face(face_encoding)
             
             if match:
                 return self._success_response(person_id, "Face verified")
             
             # Register new face if no match found
-            person_id = self._register_new_face(face_encoding, image)
+            self._register_new_face(person_id, face_encoding, image, face_location)
             return self._success_response(person_id, "New face registered")
 
         except Exception as e:
@@ -53,37 +61,34 @@ class BiometricVerifier:
             return None
 
     def _extract_face_encoding(self, image):
-        """Extract face encodings from image"""
+        """Extract the first face location and its encoding from image"""
         face_locations = face_recognition.face_locations(image)
         if not face_locations:
-            return None
-        return face_recognition.face_encodings(image, face_locations)[0]
+            return None, None
+        return face_locations[0], face_recognition.face_encodings(image, face_locations)[0]
 
     def _match_known_faces(self, face_encoding):
-        """Compare against database of known faces"""
-        for filename in os.listdir(self.known_faces_dir):
-            if filename.endswith('.npy'):
-                known_enc = np.load(os.path.join(self.known_faces_dir, filename))
-                matches = face_recognition.compare_faces(
-                    [known_enc], 
-                    face_encoding,
-                    tolerance=self.tolerance
-                )
-                if matches[0]:
-                    return True, filename.split('.')[0]
-        return False, None
+        """Compare against the in-memory gallery of known faces"""
+        person_id = self.gallery.match(face_encoding, self.tolerance)
+        return person_id is not None, person_id
 
-    def _register_new_face(self, face_encoding, image):
-        """Register a new face in the system"""
+    def _reserve_new_face(self, face_encoding):
+        """Pick an id and make the face matchable immediately"""
         face_id = hashlib.sha256(
             datetime.now().strftime("%Y%m%d%H%M%S%f").encode()
         ).hexdigest()[:16]
-        
-        # Save encoding
-        np.save(os.path.join(self.known_faces_dir, f'{face_id}.npy'), face_encoding)
-        
-        # Save image for reference
-        cv2.imwrite(os.path.join(self.known_faces_dir, f'{face_id}.jpg'), image)
+        self.gallery.add(face_id, face_encoding)
+        return face_id
+
+    def _register_new_face(self, face_id, face_encoding, image, face_location=None):
+        """Register a new face in the system"""
+        try:
+            # Files are written in the background; only a face thumbnail is kept
+            thumbnail = self.writer.make_thumbnail(image, face_location)
+            self.writer.submit(face_id, face_encoding, thumbnail)
+        except Exception:
+            self.gallery.discard(face_id)
+            raise
         
         return face_id
 
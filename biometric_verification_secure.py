@@ -5,6 +5,8 @@ import os
 import base64
 from datetime import datetime
 import hashlib
+from enrollment_writer import EnrollmentWriter
+from gallery import FaceGallery
 
 class SecureBiometricVerifier:
     def __init__(self):
@@ -15,9 +17,11 @@ class SecureBiometricVerifier:
         self.required_blinks = 2  # For liveness detection
         from database import Database
         self.db = Database()
+        self.writer = EnrollmentWriter(self.known_faces_dir, db=self.db)
+        self.gallery = FaceGallery(self.known_faces_dir)
 
-    def verify_face(self, image_data, is_live_check=False):
-        """Enhanced verification with anti-spoofing measures"""
+    def verify_face(self, image_data, is_live_check=False, wallet_address=None):
+        """Enhanced verification with anti-spoofing measures and wallet association"""
         try:
             image = self._parse_image(image_data)
             if image is None:
@@ -38,14 +42,28 @@ class SecureBiometricVerifier:
 
             # 4. Face recognition
             face_encoding = face_recognition.face_encodings(image, face_locations)[0]
-            match, person_id = self._match_known_faces(face_encoding)
-            
-            if match:
-                return self._success_response(person_id, "Verified")
-            
-            # Register new face if needed
-            person_id = self._register_new_face(face_encoding, image)
-            return self._success_response(person_id, "New face registered")
+            # Match and register under one lock so concurrent requests
+            # for the same new face don't both register it
+            with self.gallery.lock:
+                match, person_id = self._match_known_faces(face_encoding)
+                if not match:
+                    person_id = self._reserve_new_face(face_encoding)
+
+            if not match:
+                # Register new face if needed; the wallet travels with
+                # the enrollment since its row is written in the background
+                self._register_new_face(
+                    person_id, face_encoding, image,
+                    wallet_address=wallet_address,
+                    face_location=face_locations[0]
+                )
+                return self._success_response(person_id, "New face registered")
+
+            if wallet_address and not self.db.update_wallet(person_id, wallet_address):
+                # The row may still be spooled or the database down
+                print(f"Wallet update for {person_id} deferred to enrollment writer")
+                self.writer.update_wallet(person_id, wallet_address)
+            return self._success_response(person_id, "Verified")
 
         except Exception as e:
             return self._error_response(f"Verification error: {str(e)}")
@@ -92,60 +110,30 @@ class SecureBiometricVerifier:
             return None
 
     def _match_known_faces(self, face_encoding):
-        """Compare against database of known faces"""
-        for filename in os.listdir(self.known_faces_dir):
-            if filename.endswith('.npy'):
-                known_enc = np.load(os.path.join(self.known_faces_dir, filename))
-                matches = face_recognition.compare_faces(
-                    [known_enc], 
-                    face_encoding,
-                    tolerance=self.tolerance
-                )
-                if matches[0]:
-                    return True, filename.split('.')[0]
-        return False, None
+        """Compare against the in-memory gallery of known faces"""
+        person_id = self.gallery.match(face_encoding, self.tolerance)
+        return person_id is not None, person_id
 
-    def _register_new_face(self, face_encoding, image, wallet_address=None):
-        """Register a new face in the system with database tracking"""
+    def _reserve_new_face(self, face_encoding):
+        """Pick an id and make the face matchable immediately"""
         face_id = hashlib.sha256(
             datetime.now().strftime("%Y%m%d%H%M%S%f").encode()
         ).hexdigest()[:16]
-        
-        # Save files
-        encoding_path = os.path.join(self.known_faces_dir, f'{face_id}.npy')
-        image_path = os.path.join(self.known_faces_dir, f'{face_id}.jpg')
-        np.save(encoding_path, face_encoding)
-        cv2.imwrite(image_path, image)
-        
-        # Store in database
-        self.db.create_verification(
-            verification_id=face_id,
-            encoding_path=encoding_path,
-            image_path=image_path,
-            wallet=wallet_address
-        )
-        
+        self.gallery.add(face_id, face_encoding)
         return face_id
 
-    def verify_face(self, image_data, is_live_check=False, wallet_address=None):
-        """Enhanced verification with wallet association"""
-        result = super().verify_face(image_data, is_live_check)
-        if result['success'] and wallet_address:
-            # Update wallet address if verification was successful
-            session = self.db.Session()
-            try:
-                record = session.query(VerificationRecord)\
-                    .filter_by(verification_id=result['verification_id'])\
-                    .first()
-                if record:
-                    record.wallet_address = wallet_address
-                    session.commit()
-            except Exception as e:
-                session.rollback()
-                print(f"Database error: {str(e)}")
-            finally:
-                session.close()
-        return result
+    def _register_new_face(self, face_id, face_encoding, image, wallet_address=None,
+                           face_location=None):
+        """Register a new face in the system with database tracking"""
+        try:
+            # Files and the database row are written in the background
+            thumbnail = self.writer.make_thumbnail(image, face_location)
+            self.writer.submit(face_id, face_encoding, thumbnail, wallet_address)
+        except Exception:
+            self.gallery.discard(face_id)
+            raise
+        
+        return face_id
 
     def _success_response(self, verification_id, message):
         return {
@@ -43,6 +43,33 @@ class Database:
         finally:
             session.close()
 
+    def create_verifications(self, records):
+        """Insert many verifications in one transaction, skipping existing ids"""
+        session = self.Session()
+        try:
+            ids = [r['verification_id'] for r in records]
+            existing = {
+                vid for (vid,) in session.query(VerificationRecord.verification_id)
+                .filter(VerificationRecord.verification_id.in_(ids))
+            }
+            session.add_all([
+                VerificationRecord(
+                    verification_id=r['verification_id'],
+                    face_encoding_path=r['encoding_path'],
+                    image_path=r.get('image_path'),
+                    wallet_address=r.get('wallet')
+                )
+                for r in records if r['verification_id'] not in existing
+            ])
+            session.commit()
+            return True
+        except Exception as e:
+            session.rollback()
+            print(f"Database error: {str(e)}")
+            return False
+        finally:
+            session.close()
+
     def get_verification(self, verification_id):
         session = self.Session()
         try:
@@ -52,6 +79,24 @@ class Database:
         finally:
             session.close()
 
+    def update_wallet(self, verification_id, wallet):
+        session = self.Session()
+        try:
+            record = session.query(VerificationRecord)\
+                .filter_by(verification_id=verification_id)\
+                .first()
+            if record:
+                record.wallet_address = wallet
+                session.commit()
+                return True
+            return False
+        except Exception as e:
+            session.rollback()
+            print(f"Database error: {str(e)}")
+            return False
+        finally:
+            session.close()
+
     def deactivate_verification(self, verification_id):
         session = self.Session()
         try:
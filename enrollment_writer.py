@@ -0,0 +1,298 @@
+import cv2
+import numpy as np
+import os
+import fcntl
+import threading
+import atexit
+import time
+import uuid
+from gallery import SPOOL_DIR, FAILED_DIR, WALLET_SUFFIX, atomic_write, fsync_dir
+
+class EnrollmentWriter:
+    """Persist enrollments off the request path.
+
+    Each enrollment is first spooled to disk (encoding plus a face
+    thumbnail) and fsynced before ``submit`` returns, so anything that was
+    acknowledged survives a crash. The spool directory is the queue: a
+    background thread writes the ``.npy``/``.jpg`` artifacts, batches the
+    database inserts and removes each entry once everything is durable.
+    ``submit`` never waits for the thread, so a slow or unavailable
+    database cannot stall verification.
+
+    Every process gets its own spool directory, held by a lock file for its
+    lifetime. Spool directories whose owner has died (and entries moved
+    aside in an earlier run) are adopted on startup. Records that fail are
+    retried one at a time with backoff; after ``max_attempts`` they are
+    moved to ``failed/`` so they don't hold up the rest.
+    """
+
+    # reenroll.py re-encodes from these thumbnails. dlib aligns a 150px chip
+    # with 0.25 padding around the landmarks, so the crop keeps a 0.5 margin
+    # (no black out-of-bounds fill in the chip) and at least 2x the chip's
+    # resolution, keeping re-encoded galleries close to live captures.
+    THUMBNAIL_SIZE = 320
+    THUMBNAIL_MARGIN = 0.5
+
+    def __init__(self, known_faces_dir, db=None, batch_size=16,
+                 thumbnail_size=THUMBNAIL_SIZE, retry_delay=1.0, max_retry_delay=60.0,
+                 max_attempts=8, poll_interval=1.0):
+        self.known_faces_dir = known_faces_dir
+        self.spool_root = os.path.join(known_faces_dir, SPOOL_DIR)
+        self.failed_dir = os.path.join(known_faces_dir, FAILED_DIR)
+        os.makedirs(self.spool_root, exist_ok=True)
+        os.makedirs(self.failed_dir, exist_ok=True)
+        self.db = db
+        self.batch_size = batch_size
+        self.thumbnail_size = thumbnail_size
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self.max_attempts = max_attempts
+        self.poll_interval = poll_interval
+        self._attempts = {}  # spool path -> (attempts, next try time)
+        self._wake = threading.Event()
+        self._closed = threading.Event()
+
+        token = f'{os.getpid()}-{uuid.uuid4().hex[:8]}'
+        self.spool_dir = os.path.join(self.spool_root, token)
+        self._owner_lock = _lock(self.spool_dir + '.lock', blocking=True)
+        os.makedirs(self.spool_dir)
+
+        # Take over what dead processes acknowledged but never wrote
+        self._adopt_orphans()
+
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def make_thumbnail(self, image, face_location=None, margin=THUMBNAIL_MARGIN):
+        """Crop the face (with a margin) and cap its longest side"""
+        if face_location is not None:
+            top, right, bottom, left = face_location
+            pad_y = int((bottom - top) * margin)
+            pad_x = int((right - left) * margin)
+            height, width = image.shape[:2]
+            image = image[max(top - pad_y, 0):min(bottom + pad_y, height),
+                          max(left - pad_x, 0):min(right + pad_x, width)]
+
+        longest = max(image.shape[:2])
+        if longest > self.thumbnail_size:
+            scale = self.thumbnail_size / float(longest)
+            image = cv2.resize(image, None, fx=scale, fy=scale,
+                               interpolation=cv2.INTER_AREA)
+        return np.ascontiguousarray(image)
+
+    def submit(self, face_id, face_encoding, thumbnail, wallet_address=None):
+        """Durably hand off an enrollment; never waits for the writer"""
+        self._spool(f'{face_id}.npz', face_id=np.array(face_id),
+                    encoding=np.asarray(face_encoding), thumbnail=thumbnail,
+                    wallet=np.array(wallet_address or ''))
+        self._wake.set()
+        return face_id
+
+    def update_wallet(self, face_id, wallet_address):
+        """Durably queue a wallet change for a row that may not exist yet"""
+        self._spool(f'{face_id}{WALLET_SUFFIX}', face_id=np.array(face_id),
+                    wallet=np.array(wallet_address))
+        self._wake.set()
+
+    def flush(self, timeout=None):
+        """Wait until this process's spool is empty; False on timeout"""
+        deadline = None if timeout is None else time.time() + timeout
+        while self._entries():
+            if deadline is not None and time.time() > deadline:
+                return False
+            self._wake.set()
+            time.sleep(0.01)
+        return True
+
+    def close(self):
+        """Stop after one last pass; anything left is adopted on next start"""
+        if not self._thread.is_alive():
+            return
+        self._closed.set()
+        self._wake.set()
+        self._thread.join()
+        if not self._entries():
+            for filename in os.listdir(self.spool_dir):
+                os.remove(os.path.join(self.spool_dir, filename))
+            os.rmdir(self.spool_dir)
+            os.remove(self.spool_dir + '.lock')
+        self._owner_lock.close()
+
+    def _spool(self, filename, **arrays):
+        atomic_write(os.path.join(self.spool_dir, filename),
+                     lambda f: np.savez(f, **arrays))
+
+    def _entries(self):
+        return sorted(f for f in os.listdir(self.spool_dir) if f.endswith('.npz'))
+
+    def _adopt_orphans(self):
+        sources = [(self.failed_dir, None)]
+        for name in os.listdir(self.spool_root):
+            path = os.path.join(self.spool_root, name)
+            if path == self.spool_dir or not os.path.isdir(path):
+                continue
+            owner = _lock(path + '.lock', blocking=False)
+            if owner is not None:
+                sources.append((path, owner))
+
+        for path, owner in sources:
+            try:
+                for filename in os.listdir(path):
+                    src = os.path.join(path, filename)
+                    if filename.endswith('.npz'):
+                        try:
+                            os.replace(src, os.path.join(self.spool_dir, filename))
+                        except FileNotFoundError:
+                            pass  # Another process adopted it first
+                    elif owner is not None:
+                        # Never acknowledged by its dead owner, safe to drop
+                        os.remove(src)
+                if owner is not None:
+                    os.rmdir(path)
+                    os.remove(path + '.lock')
+            except (FileNotFoundError, OSError) as e:
+                print(f"Enrollment recovery error: {str(e)}")
+            finally:
+                if owner is not None:
+                    owner.close()
+        fsync_dir(self.spool_dir)
+
+    def _run(self):
+        while True:
+            self._wake.clear()
+            try:
+                self._drain()
+            except Exception as e:
+                print(f"Enrollment writer error: {str(e)}")
+            if self._closed.is_set():
+                return
+            self._wake.wait(self._next_wait())
+
+    def _next_wait(self):
+        now = time.time()
+        waits = [next_try - now for _, next_try in self._attempts.values()]
+        return max(min(waits + [self.poll_interval]), 0)
+
+    def _drain(self):
+        now = time.time()
+        entries = self._entries()
+        self._attempts = {
+            p: a for p, a in self._attempts.items()
+            if os.path.basename(p) in entries
+        }
+        ready = [
+            os.path.join(self.spool_dir, f) for f in entries
+            if self._attempts.get(os.path.join(self.spool_dir, f), (0, 0))[1] <= now
+        ]
+        # Enrollments first so wallet updates find their rows
+        enrollments = [p for p in ready if not p.endswith(WALLET_SUFFIX)]
+        wallets = [p for p in ready if p.endswith(WALLET_SUFFIX)]
+        for start in range(0, len(enrollments), self.batch_size):
+            self._write_enrollments(enrollments[start:start + self.batch_size])
+        for path in wallets:
+            self._write_wallet(path)
+
+    def _write_enrollments(self, spool_paths):
+        written = []
+        for spool_path in spool_paths:
+            try:
+                written.append((spool_path, self._write_artifacts(spool_path)))
+            except FileNotFoundError:
+                self._attempts.pop(spool_path, None)  # Already done
+            except Exception as e:
+                self._failed(spool_path, e)
+        if not written:
+            return
+
+        if self.db is None or self.db.create_verifications([r for _, r in written]):
+            done = [p for p, _ in written]
+        else:
+            # Retry one by one so a bad record doesn't sink the batch
+            done = []
+            for spool_path, record in written:
+                if self.db.create_verifications([record]):
+                    done.append(spool_path)
+                else:
+                    self._failed(spool_path, RuntimeError(
+                        f"Insert failed for {record['verification_id']}"
+                    ))
+        self._done(done)
+
+    def _write_wallet(self, spool_path):
+        try:
+            with np.load(spool_path) as entry:
+                face_id = str(entry['face_id'])
+                wallet = str(entry['wallet'])
+        except FileNotFoundError:
+            return
+        if self.db is None or self.db.update_wallet(face_id, wallet):
+            self._done([spool_path])
+        else:
+            self._failed(spool_path, RuntimeError(f"No row yet for {face_id}"))
+
+    def _write_artifacts(self, spool_path):
+        with np.load(spool_path) as entry:
+            face_id = str(entry['face_id'])
+            encoding = entry['encoding']
+            thumbnail = entry['thumbnail']
+            wallet = str(entry['wallet']) or None
+
+        encoding_path = os.path.join(self.known_faces_dir, f'{face_id}.npy')
+        image_path = os.path.join(self.known_faces_dir, f'{face_id}.jpg')
+        ok, jpeg = cv2.imencode('.jpg', thumbnail)
+        if not ok:
+            raise RuntimeError(f"Could not encode thumbnail for {face_id}")
+        atomic_write(image_path, lambda f: f.write(jpeg.tobytes()))
+        atomic_write(encoding_path, lambda f: np.save(f, encoding))
+        return {
+            'verification_id': face_id,
+            'encoding_path': encoding_path,
+            'image_path': image_path,
+            'wallet': wallet
+        }
+
+    def _done(self, spool_paths):
+        # Artifacts and rows are durable; only now drop the spool entries
+        for spool_path in spool_paths:
+            self._attempts.pop(spool_path, None)
+            try:
+                os.remove(spool_path)
+            except FileNotFoundError:
+                pass
+        if spool_paths:
+            fsync_dir(self.spool_dir)
+
+    def _failed(self, spool_path, error):
+        attempts = self._attempts.get(spool_path, (0, 0))[0] + 1
+        if attempts >= self.max_attempts:
+            self._attempts.pop(spool_path, None)
+            print(f"Enrollment writer giving up on {os.path.basename(spool_path)} "
+                  f"after {attempts} attempts: {str(error)}")
+            try:
+                os.replace(spool_path, os.path.join(
+                    self.failed_dir, os.path.basename(spool_path)
+                ))
+            except FileNotFoundError:
+                pass
+            return
+        delay = min(self.retry_delay * 2 ** (attempts - 1), self.max_retry_delay)
+        self._attempts[spool_path] = (attempts, time.time() + delay)
+        print(f"Enrollment writer error: {str(error)}")
+
+def _lock(path, blocking):
+    """Return an open file holding an exclusive flock on path, or None"""
+    while True:
+        f = open(path, 'a')
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+        except BlockingIOError:
+            f.close()
+            return None
+        try:
+            # The lock is only ours if nobody removed the file meanwhile
+            if os.stat(path).st_ino == os.fstat(f.fileno()).st_ino:
+                return f
+        except FileNotFoundError:
+            pass
+        f.close()
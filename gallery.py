@@ -0,0 +1,260 @@
+import numpy as np
+import os
+import threading
+
+CURRENT_POINTER = 'CURRENT_GALLERY'
+SPOOL_DIR = 'pending'
+FAILED_DIR = 'failed'
+WALLET_SUFFIX = '.wallet.npz'
+
+def gallery_path(known_faces_dir, version):
+    return os.path.join(known_faces_dir, f'gallery-{version}.npz')
+
+def current_version(known_faces_dir):
+    """Return the active gallery version, or None if only .npy files exist"""
+    try:
+        with open(os.path.join(known_faces_dir, CURRENT_POINTER)) as f:
+            return f.read().strip() or None
+    except FileNotFoundError:
+        return None
+
+def load_gallery(known_faces_dir):
+    """Load known encodings as parallel (ids, encodings) lists.
+
+    The active gallery version is used when one has been published; any
+    per-face .npy files enrolled after it are added on top, except ids the
+    gallery marks as skipped, whose .npy still holds the old model's
+    encoding. If the published file is missing the .npy files are used.
+    """
+    ids, encodings = load_version(known_faces_dir, current_version(known_faces_dir))
+    known = set(ids) | set(skipped_ids(known_faces_dir))
+    for filename in sorted(os.listdir(known_faces_dir)):
+        if filename.endswith('.npy') and filename.split('.')[0] not in known:
+            ids.append(filename.split('.')[0])
+            encodings.append(np.load(os.path.join(known_faces_dir, filename)))
+    return ids, encodings
+
+def load_version(known_faces_dir, version):
+    if version is None:
+        return [], []
+    try:
+        with np.load(gallery_path(known_faces_dir, version)) as data:
+            return [str(i) for i in data['ids']], list(data['encodings'])
+    except FileNotFoundError:
+        print(f"Gallery warning: {version} is published but missing, "
+              f"falling back to .npy files")
+        return [], []
+
+def skipped_ids(known_faces_dir, version=None):
+    """Ids a gallery version could not re-encode"""
+    version = version or current_version(known_faces_dir)
+    if version is None:
+        return []
+    try:
+        with np.load(gallery_path(known_faces_dir, version)) as data:
+            return [str(i) for i in data['skipped']] if 'skipped' in data else []
+    except FileNotFoundError:
+        return []
+
+def write_gallery(known_faces_dir, version, ids, encodings, skipped=()):
+    """Write a gallery version next to the active one without switching"""
+    path = gallery_path(known_faces_dir, version)
+    atomic_write(path, lambda f: np.savez(
+        f, ids=np.array(ids, dtype=str), encodings=np.asarray(encodings),
+        skipped=np.array(list(skipped), dtype=str)
+    ))
+    return path
+
+def publish_gallery(known_faces_dir, version):
+    """Atomically make version the active gallery"""
+    pointer = os.path.join(known_faces_dir, CURRENT_POINTER)
+    atomic_write(pointer, lambda f: f.write(version.encode()))
+
+def atomic_write(path, write):
+    """Write through a fsynced temp file, then rename it into place"""
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        write(f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    fsync_dir(os.path.dirname(path) or '.')
+
+def fsync_dir(path):
+    """Make renames, creates and unlinks in path durable"""
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+class FaceGallery:
+    """Thread-safe in-memory view of the known faces.
+
+    Ids and encodings live in one list and one stacked array that are only
+    replaced together under ``lock``. Callers that match and then register
+    should hold ``lock`` across both steps, and nothing slow.
+
+    Faces enrolled by other processes sharing the directory are picked up
+    by a background thread every ``refresh_interval`` seconds rather than
+    on the request path: when the directory or a spool changes, new
+    ``.npy`` files and pending spool entries are loaded incrementally.
+    Publishing a new gallery version rewrites the pointer, which triggers a
+    full reload.
+    """
+
+    def __init__(self, known_faces_dir, refresh_interval=1.0):
+        self.known_faces_dir = known_faces_dir
+        self.spool_root = os.path.join(known_faces_dir, SPOOL_DIR)
+        self.lock = threading.RLock()
+        self._ids, self._encodings, self._known = [], None, set()
+        self._local = {}  # Added here but possibly not on disk yet
+        self._stamp = None
+        self._version = None
+        self._reload()
+        self.refresh()
+        if refresh_interval:
+            self._stop = threading.Event()
+            threading.Thread(
+                target=self._refresh_loop, args=(refresh_interval,), daemon=True
+            ).start()
+
+    def __len__(self):
+        return len(self._ids)
+
+    def match(self, face_encoding, tolerance):
+        """Return the id of the first known face within tolerance, or None"""
+        with self.lock:
+            if not self._ids:
+                return None
+            distances = np.linalg.norm(self._encodings - face_encoding, axis=1)
+            hits = np.flatnonzero(distances <= tolerance)
+            return self._ids[hits[0]] if len(hits) else None
+
+    def add(self, face_id, face_encoding):
+        with self.lock:
+            self._local[face_id] = face_encoding
+            self._add([face_id], [face_encoding])
+
+    def discard(self, face_id):
+        """Forget a face whose enrollment could not be persisted"""
+        with self.lock:
+            self._local.pop(face_id, None)
+            if face_id in self._known and face_id in self._ids:
+                index = self._ids.index(face_id)
+                self._ids = self._ids[:index] + self._ids[index + 1:]
+                self._encodings = np.delete(self._encodings, index, axis=0)
+                self._known.discard(face_id)
+
+    def refresh(self):
+        """Load faces enrolled by other processes since the last look.
+
+        Directory scans and file loads happen outside ``lock``; it is only
+        taken to swap in the result.
+        """
+        stamp = self._dir_stamp()
+        if stamp == self._stamp:
+            return
+        self._stamp = stamp
+        if current_version(self.known_faces_dir) != self._version:
+            self._reload()
+        with self.lock:
+            known = set(self._known)
+        ids, encodings = [], []
+        for face_id, path in self._unseen_files(known):
+            try:
+                if path.endswith('.npy'):
+                    encoding = np.load(path)
+                else:
+                    with np.load(path) as entry:
+                        encoding = entry['encoding']
+            except (FileNotFoundError, ValueError, OSError, KeyError):
+                # Spool entry drained (or still being renamed) meanwhile;
+                # its .npy shows up on a later refresh
+                continue
+            ids.append(face_id)
+            encodings.append(encoding)
+        with self.lock:
+            local = list(self._local)
+        written = [
+            face_id for face_id in local
+            if os.path.exists(os.path.join(self.known_faces_dir, f'{face_id}.npy'))
+        ]
+        with self.lock:
+            self._add(ids, encodings)
+            for face_id in written:
+                self._local.pop(face_id, None)
+
+    def close(self):
+        if hasattr(self, '_stop'):
+            self._stop.set()
+
+    def _refresh_loop(self, interval):
+        while not self._stop.wait(interval):
+            try:
+                self.refresh()
+            except Exception as e:
+                print(f"Gallery refresh error: {str(e)}")
+
+    def _reload(self):
+        version = current_version(self.known_faces_dir)
+        ids, encodings = load_gallery(self.known_faces_dir)
+        skipped = set(skipped_ids(self.known_faces_dir, version))
+        with self.lock:
+            self._version = version
+            self._ids, self._encodings = [], None
+            # Skipped ids are never picked up from their stale .npy files
+            self._known = set(skipped)
+            self._add(ids, encodings)
+            # Keep faces registered here whose files aren't written yet
+            for face_id in [i for i in self._local if i in self._known]:
+                del self._local[face_id]
+            self._add(list(self._local), list(self._local.values()))
+
+    def _add(self, ids, encodings):
+        ids_and_encodings = [
+            (i, e) for i, e in zip(ids, encodings) if i not in self._known
+        ]
+        if not ids_and_encodings:
+            return
+        new_ids = [i for i, _ in ids_and_encodings]
+        stacked = np.array([e for _, e in ids_and_encodings], dtype=np.float64)
+        encodings = (np.vstack([self._encodings, stacked])
+                     if len(self._ids) else stacked)
+        self._encodings, self._ids = encodings, self._ids + new_ids
+        self._known.update(new_ids)
+
+    def _spool_dirs(self):
+        if not os.path.isdir(self.spool_root):
+            return []
+        return [
+            os.path.join(self.spool_root, name)
+            for name in sorted(os.listdir(self.spool_root))
+            if os.path.isdir(os.path.join(self.spool_root, name))
+        ]
+
+    def _unseen_files(self, known):
+        for filename in sorted(os.listdir(self.known_faces_dir)):
+            face_id = filename.split('.')[0]
+            if filename.endswith('.npy') and face_id not in known:
+                yield face_id, os.path.join(self.known_faces_dir, filename)
+        for spool_dir in self._spool_dirs():
+            try:
+                filenames = sorted(os.listdir(spool_dir))
+            except FileNotFoundError:
+                continue
+            for filename in filenames:
+                face_id = filename.split('.')[0]
+                if (filename.endswith('.npz') and not filename.endswith(WALLET_SUFFIX)
+                        and face_id not in known):
+                    yield face_id, os.path.join(spool_dir, filename)
+
+    def _dir_stamp(self):
+        stamps = []
+        for path in [self.known_faces_dir, self.spool_root] + self._spool_dirs():
+            try:
+                stamps.append(os.stat(path).st_mtime_ns)
+            except FileNotFoundError:
+                stamps.append(None)
+        # The pointer is read too, in case a publish lands within one mtime tick
+        return tuple(stamps) + (current_version(self.known_faces_dir),)
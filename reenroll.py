@@ -0,0 +1,222 @@
+import face_recognition
+from face_recognition import api as face_api
+import dlib
+import cv2
+import numpy as np
+import os
+import argparse
+import time
+import queue
+from itertools import islice
+from multiprocessing import Pool
+from gallery import write_gallery, publish_gallery, atomic_write
+
+def iter_reference_images(known_faces_dir, skip=()):
+    """Stream (face_id, path) for every reference image not yet encoded"""
+    with os.scandir(known_faces_dir) as entries:
+        for entry in entries:
+            if entry.is_file() and entry.name.endswith('.jpg'):
+                face_id = entry.name.split('.')[0]
+                if face_id not in skip:
+                    yield face_id, entry.path
+
+def iter_batches(items, batch_size):
+    items = iter(items)
+    while True:
+        batch = list(islice(items, batch_size))
+        if not batch:
+            return
+        yield batch
+
+def _init_worker():
+    # One process per core; keep each one single-threaded
+    cv2.setNumThreads(1)
+
+def encode_batch(args):
+    """Decode, detect and encode one batch of reference images"""
+    batch, dtype = args
+    face_ids, images, locations, skipped = [], [], [], []
+    for face_id, path in batch:
+        try:
+            image = cv2.imread(path)
+            face_locations = face_recognition.face_locations(image) if image is not None else []
+        except Exception as e:
+            print(f"Re-enrollment error on {face_id}: {str(e)}")
+            face_locations = []
+        if not face_locations:
+            skipped.append(face_id)
+            continue
+        face_ids.append(face_id)
+        images.append(image)
+        locations.append(face_locations[0])
+
+    try:
+        encodings = encode_faces(images, locations) if images else []
+    except Exception:
+        # Find the bad image(s) one by one instead of losing the batch
+        encoded_ids, encodings = [], []
+        for face_id, image, location in zip(face_ids, images, locations):
+            try:
+                encodings.extend(encode_faces([image], [location]))
+                encoded_ids.append(face_id)
+            except Exception as e:
+                print(f"Re-enrollment error on {face_id}: {str(e)}")
+                skipped.append(face_id)
+        face_ids = encoded_ids
+
+    if not encodings:
+        return face_ids, np.empty((0, 128), dtype=dtype), skipped
+    return face_ids, np.asarray(encodings, dtype=dtype), skipped
+
+def encode_faces(images, locations):
+    """Encode one face per image in a single batched dlib call.
+
+    Uses the same landmarks (5-point) and jitter count as
+    face_recognition.face_encodings' defaults, so the encodings match what
+    verify_face produces. Images are passed unconverted for the same reason.
+    """
+    batch_faces = []
+    for image, location in zip(images, locations):
+        faces = dlib.full_object_detections()
+        faces.append(face_api.pose_predictor_5_point(image, face_api._css_to_rect(location)))
+        batch_faces.append(faces)
+    descriptors = face_api.face_encoder.compute_face_descriptor(images, batch_faces, 1)
+    return [np.array(faces[0]) for faces in descriptors]
+
+class ReEnroller:
+    """Re-encode every stored identity into a new gallery version.
+
+    Finished batches are saved as parts under ``gallery-<version>.parts`` so
+    an interrupted run picks up where it stopped. The new gallery is only
+    published once every image has been processed, and not at all if some
+    could not be re-encoded unless ``allow_skipped`` is set. Running
+    verifiers reload on publish; pause enrollment during a run, since faces
+    registered meanwhile are still encoded with the old model.
+    """
+
+    def __init__(self, known_faces_dir='data/known_faces', version=None,
+                 workers=None, batch_size=32, dtype='float64', max_in_flight=None):
+        self.known_faces_dir = known_faces_dir
+        self.version = version or time.strftime('%Y%m%d%H%M%S')
+        self.workers = workers or os.cpu_count()
+        self.batch_size = batch_size
+        self.dtype = dtype
+        # Keep only a few batches queued so the image set stays streamed
+        self.max_in_flight = max_in_flight or 2 * self.workers
+        self.parts_dir = os.path.join(
+            known_faces_dir, f'gallery-{self.version}.parts'
+        )
+        os.makedirs(self.parts_dir, exist_ok=True)
+
+    def run(self, publish=True, allow_skipped=False):
+        done = self._completed_ids()
+        self._next_part = len(self._part_files())
+        self._processed = 0
+        start = time.time()
+
+        batches = iter_batches(
+            iter_reference_images(self.known_faces_dir, skip=done),
+            self.batch_size
+        )
+        results = queue.Queue()
+        in_flight = 0
+        self._error = None
+        with Pool(self.workers, initializer=_init_worker) as pool:
+            for batch in batches:
+                while in_flight >= self.max_in_flight:
+                    self._save_result(results.get(), start)
+                    in_flight -= 1
+                if self._error is not None:
+                    break
+                pool.apply_async(encode_batch, ((batch, self.dtype),),
+                                 callback=results.put, error_callback=results.put)
+                in_flight += 1
+            # Save everything that finished before reporting a failure
+            while in_flight:
+                self._save_result(results.get(), start)
+                in_flight -= 1
+        if self._error is not None:
+            # Finished parts stay on disk; rerun with the same version to resume
+            raise self._error
+
+        elapsed = time.time() - start
+        ids, encodings, skipped = self._merge_parts()
+        write_gallery(self.known_faces_dir, self.version, ids, encodings, skipped)
+        published = publish and (allow_skipped or not skipped)
+        if published:
+            publish_gallery(self.known_faces_dir, self.version)
+        for filename in self._part_files():
+            os.remove(os.path.join(self.parts_dir, filename))
+        os.rmdir(self.parts_dir)
+
+        return {
+            'version': self.version,
+            'encoded': len(ids),
+            'skipped': skipped,
+            'published': published,
+            'images_per_second': self._processed / max(elapsed, 1e-9)
+        }
+
+    def _save_result(self, result, start):
+        if isinstance(result, Exception):
+            self._error = self._error or result
+            return
+        face_ids, encodings, missed = result
+        self._save_part(self._next_part, face_ids, encodings, missed)
+        self._next_part += 1
+        self._processed += len(face_ids) + len(missed)
+        elapsed = time.time() - start
+        print(f"{self._processed} images, {self._processed / max(elapsed, 1e-9):.1f} images/s")
+
+    def _part_files(self):
+        return sorted(f for f in os.listdir(self.parts_dir) if f.endswith('.npz'))
+
+    def _save_part(self, index, face_ids, encodings, skipped):
+        path = os.path.join(self.parts_dir, f'part-{index:06d}.npz')
+        atomic_write(path, lambda f: np.savez(
+            f, ids=np.array(face_ids, dtype=str),
+            encodings=encodings, skipped=np.array(skipped, dtype=str)
+        ))
+
+    def _completed_ids(self):
+        done = set()
+        for filename in self._part_files():
+            with np.load(os.path.join(self.parts_dir, filename)) as part:
+                done.update(str(i) for i in part['ids'])
+                done.update(str(i) for i in part['skipped'])
+        return done
+
+    def _merge_parts(self):
+        ids, encodings, skipped = [], [], []
+        for filename in self._part_files():
+            with np.load(os.path.join(self.parts_dir, filename)) as part:
+                ids.extend(str(i) for i in part['ids'])
+                encodings.extend(part['encodings'])
+                skipped.extend(str(i) for i in part['skipped'])
+        return ids, encodings, skipped
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Re-encode all reference images into a new gallery version"
+    )
+    parser.add_argument('--dir', default='data/known_faces')
+    parser.add_argument('--version', help="Reuse a version name to resume an interrupted run")
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--batch-size', type=int, default=32)
+    parser.add_argument('--dtype', default='float64', choices=['float16', 'float32', 'float64'])
+    parser.add_argument('--no-publish', action='store_true',
+                        help="Write the new gallery without switching to it")
+    parser.add_argument('--allow-skipped', action='store_true',
+                        help="Publish even if some images could not be re-encoded")
+    args = parser.parse_args()
+
+    result = ReEnroller(
+        args.dir, args.version, args.workers, args.batch_size, args.dtype
+    ).run(publish=not args.no_publish, allow_skipped=args.allow_skipped)
+    print(f"Gallery {result['version']}: {result['encoded']} encoded, "
+          f"{len(result['skipped'])} skipped, {result['images_per_second']:.1f} images/s")
+    if result['skipped']:
+        print(f"Skipped ids: {', '.join(result['skipped'])}")
+    if not result['published'] and not args.no_publish:
+        print("Not published because images were skipped; "
+              "rerun with --allow-skipped to publish anyway")
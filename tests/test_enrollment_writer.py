@@ -0,0 +1,151 @@
+import pytest
+import numpy as np
+import os
+import glob
+from enrollment_writer import EnrollmentWriter
+
+class FakeDatabase:
+    def __init__(self, fail=False, fail_ids=()):
+        self.fail = fail
+        self.fail_ids = set(fail_ids)
+        self.batches = []
+        self.wallets = {}
+
+    def create_verifications(self, records):
+        if self.fail or any(r['verification_id'] in self.fail_ids for r in records):
+            return False
+        self.batches.append(records)
+        return True
+
+    def update_wallet(self, verification_id, wallet):
+        if self.fail or not self.inserted(verification_id):
+            return False
+        self.wallets[verification_id] = wallet
+        return True
+
+    def inserted(self, verification_id):
+        return any(r['verification_id'] == verification_id
+                   for batch in self.batches for r in batch)
+
+class CrashAfterCommitDatabase:
+    """Commits the rows, then reports failure as if the process died"""
+    def __init__(self, db):
+        self.db = db
+
+    def create_verifications(self, records):
+        self.db.create_verifications(records)
+        return False
+
+@pytest.fixture
+def frame():
+    return np.zeros((720, 1280, 3), dtype=np.uint8)
+
+@pytest.fixture
+def database(tmp_path, monkeypatch):
+    monkeypatch.setenv('DATABASE_URI', f"sqlite:///{tmp_path / 'test.db'}")
+    from database import Database
+    return Database()
+
+def spooled(faces_dir):
+    return sorted(os.path.basename(p)
+                  for p in glob.glob(str(faces_dir / 'pending' / '*' / '*.npz')))
+
+def test_enrollment_is_written_in_background(tmp_path, frame):
+    db = FakeDatabase()
+    writer = EnrollmentWriter(str(tmp_path), db=db)
+    thumbnail = writer.make_thumbnail(frame, (100, 500, 500, 100))
+    assert max(thumbnail.shape[:2]) <= writer.thumbnail_size
+
+    writer.submit('abc123', np.ones(128), thumbnail, '0x1')
+    assert writer.flush(timeout=5)
+    writer.close()
+
+    assert np.load(tmp_path / 'abc123.npy').shape == (128,)
+    assert os.path.getsize(tmp_path / 'abc123.jpg') > 0
+    assert os.listdir(tmp_path / 'pending') == []
+    assert db.batches[0][0]['verification_id'] == 'abc123'
+    assert db.batches[0][0]['wallet'] == '0x1'
+
+def test_submit_does_not_block_while_database_is_down(tmp_path, frame):
+    db = FakeDatabase(fail=True)
+    writer = EnrollmentWriter(str(tmp_path), db=db, retry_delay=0.01)
+    for i in range(100):
+        writer.submit(f'id{i:03d}', np.ones(128), writer.make_thumbnail(frame))
+
+    db.fail = False
+    assert writer.flush(timeout=10)
+    writer.close()
+    assert all(db.inserted(f'id{i:03d}') for i in range(100))
+
+def test_failing_record_is_moved_aside(tmp_path, frame):
+    db = FakeDatabase(fail_ids={'bad'})
+    writer = EnrollmentWriter(str(tmp_path), db=db, retry_delay=0.01,
+                              max_attempts=3)
+    writer.submit('bad', np.ones(128), writer.make_thumbnail(frame))
+    writer.submit('good', np.ones(128), writer.make_thumbnail(frame))
+
+    assert writer.flush(timeout=5)
+    writer.close()
+    assert db.inserted('good') and not db.inserted('bad')
+    assert os.listdir(tmp_path / 'failed') == ['bad.npz']
+
+    # Entries moved aside get another chance on the next start
+    db.fail_ids.clear()
+    writer = EnrollmentWriter(str(tmp_path), db=db)
+    assert writer.flush(timeout=5)
+    writer.close()
+    assert db.inserted('bad')
+
+def test_live_process_spool_is_not_adopted(tmp_path, frame):
+    live = EnrollmentWriter(str(tmp_path), db=FakeDatabase(fail=True),
+                            retry_delay=10)
+    live.submit('abc123', np.ones(128), live.make_thumbnail(frame))
+
+    other_db = FakeDatabase()
+    other = EnrollmentWriter(str(tmp_path), db=other_db)
+    assert other.flush(timeout=5)
+    other.close()
+    assert not other_db.inserted('abc123')
+    assert spooled(tmp_path) == ['abc123.npz']
+
+    # Once its owner is gone the entry is adopted
+    live.close()
+    writer = EnrollmentWriter(str(tmp_path), db=other_db)
+    assert writer.flush(timeout=5)
+    writer.close()
+    assert other_db.inserted('abc123')
+    assert os.listdir(tmp_path / 'pending') == []
+
+def test_wallet_update_waits_for_pending_row(tmp_path, frame):
+    db = FakeDatabase(fail=True)
+    writer = EnrollmentWriter(str(tmp_path), db=db, retry_delay=0.01)
+    writer.submit('abc123', np.ones(128), writer.make_thumbnail(frame))
+    writer.update_wallet('abc123', '0x2')
+
+    db.fail = False
+    assert writer.flush(timeout=5)
+    writer.close()
+    assert db.wallets['abc123'] == '0x2'
+
+def test_replay_skips_already_inserted_rows(tmp_path, frame, database):
+    writer = EnrollmentWriter(str(tmp_path), db=CrashAfterCommitDatabase(database),
+                              retry_delay=10)
+    writer.submit('abc123', np.ones(128), writer.make_thumbnail(frame), '0x1')
+    assert not writer.flush(timeout=0.5)
+    writer.close()
+    assert database.get_verification('abc123') is not None
+    assert spooled(tmp_path) == ['abc123.npz']
+
+    writer = EnrollmentWriter(str(tmp_path), db=database)
+    assert writer.flush(timeout=5)
+    writer.close()
+
+    assert os.listdir(tmp_path / 'pending') == []
+    session = database.Session()
+    try:
+        from database import VerificationRecord
+        rows = session.query(VerificationRecord).filter_by(verification_id='abc123')
+        assert rows.count() == 1
+        assert rows.first().wallet_address == '0x1'
+    finally:
+        session.close()
@@ -0,0 +1,62 @@
+import numpy as np
+from gallery import load_gallery, write_gallery, publish_gallery, current_version
+
+def test_published_gallery_replaces_npy_encodings(tmp_path):
+    np.save(tmp_path / 'old.npy', np.zeros(128))
+    write_gallery(str(tmp_path), 'v2', ['old'], [np.ones(128)])
+
+    # Written side by side, not active until published
+    assert current_version(str(tmp_path)) is None
+    ids, encodings = load_gallery(str(tmp_path))
+    assert ids == ['old'] and encodings[0][0] == 0
+
+    publish_gallery(str(tmp_path), 'v2')
+    np.save(tmp_path / 'new.npy', np.zeros(128))
+    ids, encodings = load_gallery(str(tmp_path))
+    assert ids == ['old', 'new']
+    assert encodings[0][0] == 1
+
+def test_face_gallery_sees_other_processes(tmp_path):
+    from gallery import FaceGallery
+    gallery = FaceGallery(str(tmp_path), refresh_interval=None)
+    assert gallery.match(np.zeros(128), 0.5) is None
+
+    gallery.add('local', np.full(128, 5.0))
+    np.save(tmp_path / 'remote.npy', np.zeros(128))
+    # Other processes' faces arrive via refresh, not on the match path
+    assert gallery.match(np.zeros(128), 0.5) is None
+    gallery.refresh()
+    assert gallery.match(np.zeros(128), 0.5) == 'remote'
+    assert gallery.match(np.full(128, 5.0), 0.5) == 'local'
+    assert len(gallery) == 2
+
+def test_face_gallery_reloads_on_publish(tmp_path, capsys):
+    from gallery import FaceGallery
+    np.save(tmp_path / 'old.npy', np.zeros(128))
+    gallery = FaceGallery(str(tmp_path), refresh_interval=None)
+    assert gallery.match(np.zeros(128), 0.5) == 'old'
+
+    write_gallery(str(tmp_path), 'v2', ['old'], [np.ones(128)])
+    publish_gallery(str(tmp_path), 'v2')
+    gallery.refresh()
+    assert gallery.match(np.ones(128), 0.5) == 'old'
+    assert gallery.match(np.zeros(128), 0.5) is None
+
+    # A pointer to a missing gallery falls back to the .npy files
+    publish_gallery(str(tmp_path), 'gone')
+    gallery.refresh()
+    assert gallery.match(np.zeros(128), 0.5) == 'old'
+    assert 'missing' in capsys.readouterr().out
+
+def test_face_gallery_keeps_local_faces_across_reload(tmp_path):
+    from gallery import FaceGallery
+    gallery = FaceGallery(str(tmp_path), refresh_interval=None)
+    gallery.add('local', np.ones(128))
+
+    write_gallery(str(tmp_path), 'v2', [], [])
+    publish_gallery(str(tmp_path), 'v2')
+    gallery.refresh()
+    assert gallery.match(np.ones(128), 0.5) == 'local'
+
+    gallery.discard('local')
+    assert gallery.match(np.ones(128), 0.5) is None
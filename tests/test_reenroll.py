@@ -0,0 +1,126 @@
+import pytest
+import numpy as np
+import os
+import reenroll
+from reenroll import ReEnroller
+from gallery import current_version, load_gallery, skipped_ids
+
+def stub_encode_batch(args):
+    """Encode each id as a constant vector; runs in the pool worker"""
+    batch, dtype = args
+    face_ids, skipped = [], []
+    for face_id, path in batch:
+        folder = os.path.dirname(path)
+        if os.path.exists(os.path.join(folder, f'crash-{face_id}')):
+            raise RuntimeError(f"Interrupted at {face_id}")
+        with open(os.path.join(folder, 'seen.log'), 'a') as f:
+            f.write(face_id + '\n')
+        if face_id.startswith('noface'):
+            skipped.append(face_id)
+        else:
+            face_ids.append(face_id)
+    encodings = np.full((len(face_ids), 128), 7, dtype=dtype)
+    return face_ids, encodings, skipped
+
+@pytest.fixture
+def faces_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(reenroll, 'encode_batch', stub_encode_batch)
+    for face_id in ('a', 'b', 'c', 'd'):
+        (tmp_path / f'{face_id}.jpg').write_bytes(b'jpg')
+        np.save(tmp_path / f'{face_id}.npy', np.zeros(128))
+    return tmp_path
+
+def seen(faces_dir):
+    with open(faces_dir / 'seen.log') as f:
+        return f.read().split()
+
+def test_run_publishes_and_cleans_up(faces_dir):
+    result = ReEnroller(str(faces_dir), 'v2', workers=1, batch_size=2).run()
+
+    assert result['encoded'] == 4 and result['published']
+    assert current_version(str(faces_dir)) == 'v2'
+    assert not os.path.exists(faces_dir / 'gallery-v2.parts')
+    ids, encodings = load_gallery(str(faces_dir))
+    assert sorted(ids) == ['a', 'b', 'c', 'd']
+    assert all(e[0] == 7 for e in encodings)
+
+def test_no_publish_writes_side_by_side(faces_dir):
+    result = ReEnroller(str(faces_dir), 'v2', workers=1).run(publish=False)
+
+    assert not result['published']
+    assert os.path.exists(faces_dir / 'gallery-v2.npz')
+    assert current_version(str(faces_dir)) is None
+
+def test_resume_does_not_reencode_finished_ids(faces_dir):
+    # Crash on the last image the stream yields so earlier ones finish
+    last = [e.name.split('.')[0] for e in os.scandir(faces_dir)
+            if e.name.endswith('.jpg')][-1]
+    (faces_dir / f'crash-{last}').touch()
+    with pytest.raises(RuntimeError):
+        ReEnroller(str(faces_dir), 'v2', workers=1, batch_size=1,
+                   max_in_flight=1).run()
+    finished = set(seen(faces_dir))
+    assert finished and last not in finished
+    assert current_version(str(faces_dir)) is None
+
+    os.remove(faces_dir / f'crash-{last}')
+    os.remove(faces_dir / 'seen.log')
+    result = ReEnroller(str(faces_dir), 'v2', workers=1, batch_size=1).run()
+
+    assert not finished & set(seen(faces_dir))
+    assert result['encoded'] == 4
+    assert current_version(str(faces_dir)) == 'v2'
+
+def test_skipped_ids_block_publish_and_npy_fallback(faces_dir):
+    (faces_dir / 'noface1.jpg').write_bytes(b'jpg')
+    np.save(faces_dir / 'noface1.npy', np.zeros(128))
+
+    result = ReEnroller(str(faces_dir), 'v2', workers=1).run()
+    assert result['skipped'] == ['noface1'] and not result['published']
+    assert current_version(str(faces_dir)) is None
+
+    result = ReEnroller(str(faces_dir), 'v2', workers=1).run(allow_skipped=True)
+    assert result['published']
+    assert skipped_ids(str(faces_dir)) == ['noface1']
+    # The old model's .npy must not be mixed into the new gallery
+    ids, _ = load_gallery(str(faces_dir))
+    assert 'noface1' not in ids
+
+def test_failure_keeps_results_already_in_flight(faces_dir):
+    first = [e.name.split('.')[0] for e in os.scandir(faces_dir)
+             if e.name.endswith('.jpg')][0]
+    (faces_dir / f'crash-{first}').touch()
+    with pytest.raises(RuntimeError):
+        ReEnroller(str(faces_dir), 'v2', workers=1, batch_size=1,
+                   max_in_flight=4).run()
+    finished = set(seen(faces_dir))
+    assert len(finished) == 3
+
+    os.remove(faces_dir / f'crash-{first}')
+    os.remove(faces_dir / 'seen.log')
+    ReEnroller(str(faces_dir), 'v2', workers=1, batch_size=1).run()
+    assert not finished & set(seen(faces_dir))
+
+def test_bad_image_is_skipped_not_fatal(tmp_path, monkeypatch):
+    def face_locations(image):
+        if image[0, 0, 0] == 1:
+            raise RuntimeError("detector failed")
+        return [(0, 10, 10, 0)]
+
+    def encode_faces(images, locations):
+        if any(image[0, 0, 0] == 2 for image in images):
+            raise RuntimeError("encoder failed")
+        return [np.ones(128) for _ in images]
+
+    monkeypatch.setattr(reenroll.face_recognition, 'face_locations', face_locations)
+    monkeypatch.setattr(reenroll, 'encode_faces', encode_faces)
+    batch = []
+    for face_id, value in (('ok', 0), ('nodetect', 1), ('noencode', 2)):
+        path = str(tmp_path / f'{face_id}.png')
+        reenroll.cv2.imwrite(path, np.full((10, 10, 3), value, dtype=np.uint8))
+        batch.append((face_id, path))
+    batch.append(('unreadable', str(tmp_path / 'missing.jpg')))
+
+    face_ids, encodings, skipped = reenroll.encode_batch((batch, 'float32'))
+    assert face_ids == ['ok'] and encodings.shape == (1, 128)
+    assert sorted(skipped) == ['nodetect', 'noencode', 'unreadable']